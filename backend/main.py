@@ -1,12 +1,16 @@
 # main.py
 import os
+import re
 import json
 import uuid
+import hashlib
 import tempfile
 import traceback
 import logging
+import time
 import asyncio
 from datetime import datetime
+from types import MappingProxyType
 from typing import Optional, Dict, Any, List
 from dotenv import load_dotenv
 load_dotenv(dotenv_path="./.env")
@@ -24,11 +28,10 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
 # Database (SQLAlchemy)
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
+from sqlalchemy import create_engine, event, select, Column, Integer, String, Text, DateTime, Float, Index
+from sqlalchemy.orm import sessionmaker, Session, declarative_base, load_only
 
 # External AI / speech / TTS
-import google.generativeai as genai
 from google.cloud import speech
 import pydub
 from gtts import gTTS
@@ -87,6 +90,15 @@ engine = create_engine(
     DATABASE_URL,
     connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
 )
+
+if "sqlite" in DATABASE_URL:
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside writers; synchronous stays at the default, so commits remain durable
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -101,20 +113,60 @@ def get_db():
 # Gemini AI Setup (optional)
 # ------------------------------------------------------------------------
 if GEMINI_API_KEY:
+    # the SDK is only imported when it will actually be used
+    import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
+
     genai.configure(api_key=GEMINI_API_KEY)
     gemini_model = genai.GenerativeModel("gemini-1.5-flash-latest")
+
+    # Quota/availability errors that are worth retrying (seeder) or backing off from (API)
+    GEMINI_TRANSIENT_ERRORS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    )
+    # quota exhaustion won't clear within seconds, so it opens the cooldown immediately
+    GEMINI_QUOTA_ERRORS = (google_exceptions.ResourceExhausted,)
 else:
     gemini_model = None
+    GEMINI_TRANSIENT_ERRORS = ()
+    GEMINI_QUOTA_ERRORS = ()
     print("WARNING: GEMINI_API_KEY not set. Using fallback analysis/summaries.")
 
+GEMINI_COOLDOWN_SECONDS = 60
+GEMINI_FAILURE_THRESHOLD = 3
+gemini_cooldown_until = 0.0
+gemini_consecutive_failures = 0
+
+def gemini_available() -> bool:
+    return gemini_model is not None and time.monotonic() >= gemini_cooldown_until
+
+def record_gemini_success() -> None:
+    global gemini_consecutive_failures
+    gemini_consecutive_failures = 0
+
+def record_gemini_failure(e: Exception) -> None:
+    # fallback scores are stored with the answers, so only back off once Gemini keeps failing
+    global gemini_cooldown_until, gemini_consecutive_failures
+    if not isinstance(e, GEMINI_TRANSIENT_ERRORS):
+        return
+    gemini_consecutive_failures += 1
+    if isinstance(e, GEMINI_QUOTA_ERRORS) or gemini_consecutive_failures >= GEMINI_FAILURE_THRESHOLD:
+        gemini_consecutive_failures = 0
+        gemini_cooldown_until = time.monotonic() + GEMINI_COOLDOWN_SECONDS
+        print(f"Gemini unavailable, using fallback for {GEMINI_COOLDOWN_SECONDS}s:", e)
+
 # ------------------------------------------------------------------------
 # Models & Schemas
 # ------------------------------------------------------------------------
 class Question(Base):
     __tablename__ = "questions"
+    __table_args__ = (Index("uq_questions_question_text", "question_text", unique=True),)
     id = Column(Integer, primary_key=True, index=True)
     category = Column(String, nullable=False)
-    difficulty = Column(String, nullable=False)
+    difficulty = Column(String, nullable=False, index=True)
     question_text = Column(Text, nullable=False)
     question_type = Column(String, nullable=False)
     canonical_answer = Column(Text, nullable=True)
@@ -139,6 +191,8 @@ class InterviewSession(Base):
 
 class Answer(Base):
     __tablename__ = "answers"
+    # every per-session lookup/count filters on session_id, and the counts also on is_followup
+    __table_args__ = (Index("ix_answers_session_followup", "session_id", "is_followup"),)
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(String, nullable=False)
     question_id = Column(Integer, nullable=True)
@@ -182,7 +236,11 @@ class SpeechService:
                 enable_automatic_punctuation=True,
             )
 
-            response = self.client.recognize(config=config, audio=audio)
+            # the sync gRPC call would otherwise block the event loop for the whole round-trip
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                None, lambda: self.client.recognize(config=config, audio=audio)
+            )
 
             if not response.results:
                 return "I'm sorry, I couldn't understand that."
@@ -198,8 +256,37 @@ speech_service = SpeechService()
 # ------------------------------------------------------------------------
 # AI evaluation helper (single question evaluation)
 # ------------------------------------------------------------------------
-async def evaluate_answer_with_ai(question_text: str, answer_text: str, candidate_name: str) -> Dict[str, Any]:
-    prompt = f"""
+# candidate starts of the JSON value inside a reply that may carry fences or prose
+JSON_START_RE = re.compile(r"[\[{]")
+JSON_DECODER = json.JSONDecoder()
+
+def parse_ai_json(text: str, expected: type = dict) -> Any:
+    """Extract and parse the first JSON value of the expected type (dict or list) in a Gemini reply."""
+    text = text.strip()
+    # common case: the reply is bare JSON, so skip the scan
+    if text[:1] in "{[" and text[-1:] in "}]":
+        try:
+            value = json.loads(text)
+            if isinstance(value, expected):
+                return value
+        except ValueError:
+            pass
+    # raw_decode stops at the end of the value, so brackets in trailing prose don't matter;
+    # invalid JSON moves on to the next bracket, and a value of the wrong type (e.g. "[]" in
+    # leading prose) is skipped whole so nothing nested inside it is picked up
+    match = JSON_START_RE.search(text)
+    while match:
+        try:
+            value, end = JSON_DECODER.raw_decode(text, match.start())
+        except ValueError:
+            match = JSON_START_RE.search(text, match.start() + 1)
+            continue
+        if isinstance(value, expected):
+            return value
+        match = JSON_START_RE.search(text, end)
+    raise ValueError(f"no JSON {expected.__name__} found in Gemini reply")
+
+EVALUATION_PROMPT = """
 You are Sarah, a friendly professional Excel interviewer speaking with {candidate_name}.
 Question asked: "{question_text}"
 Candidate's Answer: "{answer_text}"
@@ -217,39 +304,38 @@ Respond ONLY with valid JSON:
   "followup": "<follow-up or empty>"
 }}
 """
-    if not gemini_model:
+
+async def evaluate_answer_with_ai(question_text: str, answer_text: str, candidate_name: str) -> Dict[str, Any]:
+    if not gemini_available():
         return {"score": 65, "feedback": f"Thanks {candidate_name}, noted.", "followup": ""}
     try:
+        prompt = EVALUATION_PROMPT.format(
+            candidate_name=candidate_name,
+            question_text=question_text,
+            answer_text=answer_text,
+        )
         resp = await gemini_model.generate_content_async(prompt)
-        text = resp.text.strip().replace("```json", "").replace("```", "")
-        parsed = json.loads(text)
+        record_gemini_success()
+        parsed = parse_ai_json(resp.text, expected=dict)
         return {"score": int(parsed.get("score", 0)), "feedback": parsed.get("feedback", "") or "", "followup": parsed.get("followup", "") or ""}
     except Exception as e:
         print("AI evaluation error:", e)
+        record_gemini_failure(e)
         return {"score": 65, "feedback": f"Thanks {candidate_name}, noted.", "followup": ""}
 
 # ------------------------------------------------------------------------
 # Analysis: use Gemini to analyze all answers and return structured metrics
 # ------------------------------------------------------------------------
-async def generate_analysis_with_gemini(answers: List[Dict[str, Any]], overall_score: float, candidate_name: str) -> Dict[str, Any]:
-    """
-    Calls Gemini with a prompt that returns JSON with:
-    - communication_score (0-100)
-    - presentation_score (0-100)
-    - clarity_score (0-100)
-    - confidence_score (0-100)
-    - problem_solving_score (0-100)
-    - overall_score (0-100)
-    - summary (short text)
-    - suggestions (array of 2 short strings)
-    """
-    prompt = {
-        "instructions": f"You are an expert interview evaluator. Given candidate '{candidate_name}' answers below, produce a JSON object with numeric scores (0-100) for communication, presentation, clarity, confidence, problem_solving and a short 2-3 sentence summary and two improvement suggestions. Return only JSON with these keys: communication_score, presentation_score, clarity_score, confidence_score, problem_solving_score, overall_score, summary, suggestions (array of two short strings).",
-        "answers": answers,
-        "overall_score": overall_score
-    }
+ANALYSIS_SCORE_KEYS = (
+    "communication_score",
+    "presentation_score",
+    "clarity_score",
+    "confidence_score",
+    "problem_solving_score",
+    "overall_score",
+)
 
-    text_prompt = f"""
+ANALYSIS_PROMPT = """
 You are an expert interview evaluator.
 
 Candidate: {candidate_name}
@@ -262,7 +348,7 @@ The "answers" field below contains raw speech-to-text transcripts from an interv
 - Be robust: evaluate intent, clarity, and knowledge even when the wording is imperfect.
 
 Answers JSON:
-{json.dumps(answers, indent=2)}
+{answers_json}
 
 Current overall_score: {overall_score}
 
@@ -280,25 +366,50 @@ Produce ONLY a JSON object with the following keys (no extra keys, no commentary
 Return only the JSON object and nothing else.
 """
 
-    if not gemini_model:
-        return {
-            "communication_score": round(overall_score * 0.9, 1),
-            "presentation_score": round(overall_score * 0.85, 1),
-            "clarity_score": round(overall_score * 0.9, 1),
-            "confidence_score": round(overall_score * 0.8, 1),
-            "problem_solving_score": round(overall_score, 1),
-            "overall_score": round(overall_score, 1),
-            "summary": "Overall solid performance. Focus on structuring responses and practicing clarity.",
-            "suggestions": ["Structure answers with 3 steps (what/why/how).", "Practice concise explanations out loud."]
-        }
+# Used when Gemini is unavailable: derive the metrics from the average answer score
+FALLBACK_SCORE_WEIGHTS = MappingProxyType({
+    "communication_score": 0.9,
+    "presentation_score": 0.85,
+    "clarity_score": 0.9,
+    "confidence_score": 0.8,
+    "problem_solving_score": 1.0,
+    "overall_score": 1.0,
+})
+FALLBACK_SUMMARY = "Overall solid performance. Focus on structuring responses and practicing clarity."
+FALLBACK_SUGGESTIONS = ("Structure answers with 3 steps (what/why/how).", "Practice concise explanations out loud.")
+
+def fallback_analysis(overall_score: float) -> Dict[str, Any]:
+    analysis = {k: round(overall_score * w, 1) for k, w in FALLBACK_SCORE_WEIGHTS.items()}
+    analysis["summary"] = FALLBACK_SUMMARY
+    analysis["suggestions"] = list(FALLBACK_SUGGESTIONS)
+    return analysis
+
+async def generate_analysis_with_gemini(answers: List[Dict[str, Any]], overall_score: float, candidate_name: str) -> Dict[str, Any]:
+    """
+    Calls Gemini with a prompt that returns JSON with:
+    - communication_score (0-100)
+    - presentation_score (0-100)
+    - clarity_score (0-100)
+    - confidence_score (0-100)
+    - problem_solving_score (0-100)
+    - overall_score (0-100)
+    - summary (short text)
+    - suggestions (array of 2 short strings)
+    """
+    if not gemini_available():
+        return fallback_analysis(overall_score)
 
     try:
+        text_prompt = ANALYSIS_PROMPT.format(
+            candidate_name=candidate_name,
+            answers_json=json.dumps(answers, indent=2),
+            overall_score=overall_score,
+        )
         resp = await gemini_model.generate_content_async(text_prompt)
-        text = resp.text.strip().replace("```json", "").replace("```", "")
-        parsed = json.loads(text)
+        record_gemini_success()
+        parsed = parse_ai_json(resp.text, expected=dict)
         # sanitize/limit values
-        numeric_keys = ["communication_score", "presentation_score", "clarity_score", "confidence_score", "problem_solving_score", "overall_score"]
-        for k in numeric_keys:
+        for k in ANALYSIS_SCORE_KEYS:
             if k in parsed:
                 try:
                     parsed[k] = round(float(parsed[k]), 1)
@@ -313,37 +424,45 @@ Return only the JSON object and nothing else.
         return parsed
     except Exception as e:
         print("generate_analysis_with_gemini error:", e)
-        return {
-            "communication_score": round(overall_score * 0.9, 1),
-            "presentation_score": round(overall_score * 0.85, 1),
-            "clarity_score": round(overall_score * 0.9, 1),
-            "confidence_score": round(overall_score * 0.8, 1),
-            "problem_solving_score": round(overall_score, 1),
-            "overall_score": round(overall_score, 1),
-            "summary": "Overall solid performance. Focus on structuring responses and practicing clarity.",
-            "suggestions": ["Structure answers with 3 steps (what/why/how).", "Practice concise explanations out loud."]
-        }
+        record_gemini_failure(e)
+        return fallback_analysis(overall_score)
 
 # ------------------------------------------------------------------------
 # Helpers (TTS, DB helpers, PDF)
 # ------------------------------------------------------------------------
-def text_to_speech_file(text: str, session_id: str) -> str:
+def text_to_speech_file(text: str) -> str:
     try:
-        filename = f"tts_{session_id}_{uuid.uuid4().hex[:6]}.mp3"
+        # clips are keyed by content so repeated questions reuse the same file
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+        filename = f"tts_{digest}.mp3"
         filepath = os.path.join(TTS_DIR, filename)
-        tts = gTTS(text=text, lang="en", slow=False)
-        tts.save(filepath)
+        if not os.path.exists(filepath):
+            tmp_path = f"{filepath}.{uuid.uuid4().hex[:6]}.tmp"
+            try:
+                tts = gTTS(text=text, lang="en", slow=False)
+                tts.save(tmp_path)
+                os.replace(tmp_path, filepath)
+            finally:
+                # a failed synthesis must not leave partial files in the public static dir
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
         return f"/static/tts/{filename}"
     except Exception as e:
         print("TTS error:", e)
         return ""
 
+def convert_audio_to_wav(src_path: str, wav_path: str) -> None:
+    # ffmpeg decode + re-encode is CPU bound; callers run this in an executor
+    audio_seg = pydub.AudioSegment.from_file(src_path)
+    audio_seg.export(wav_path, format="wav")
+
 def get_interview_question(session: InterviewSession, db: Session) -> Optional[Question]:
-    answered_ids = [
-        q_id for (q_id,) in db.query(Answer.question_id)
-        .filter(Answer.session_id == session.id, Answer.question_id.isnot(None))
-    ]
-    return db.query(Question).filter(
+    # NOT IN (subquery): one round-trip instead of fetching the ids and sending them back
+    answered_ids = select(Answer.question_id).where(
+        Answer.session_id == session.id, Answer.question_id.isnot(None)
+    )
+    # callers only read id and question_text; skip the answer/explanation text columns
+    return db.query(Question).options(load_only(Question.id, Question.question_text)).filter(
         Question.difficulty == session.role_level,
         ~Question.id.in_(answered_ids)
     ).first()
@@ -469,22 +588,31 @@ def create_pdf_report(result: dict, session_id: str) -> Optional[str]:
         traceback.print_exc()
         return None
 
+def write_json_report(result: dict, session_id: str) -> None:
+    try:
+        json_path = os.path.join(REPORTS_DIR, f"report_{session_id}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    except Exception as e:
+        print("Failed to write JSON report:", e)
+
 
 # ------------------------------------------------------------------------
 # API Endpoints
 # ------------------------------------------------------------------------
 @app.post("/api/sessions", status_code=201)
 def create_session(session_data: SessionCreate, db: Session = Depends(get_db)):
-    session = InterviewSession(id=str(uuid.uuid4()), **session_data.dict())
+    # the id is generated here, so there is nothing to read back after the insert
+    session_id = str(uuid.uuid4())
+    session = InterviewSession(id=session_id, **session_data.dict())
     session.pending_followup = (
         f"Hi {session.candidate_name}, welcome to your interview! "
         "Before we dive into Excel, could you please introduce yourself?"
     )
     db.add(session)
     db.commit()
-    db.refresh(session)
-    print(f"[create_session] created session_id={session.id}")
-    return {"session_id": session.id}
+    print(f"[create_session] created session_id={session_id}")
+    return {"session_id": session_id}
 
 @app.get("/api/sessions/{session_id}/question")
 def get_question_endpoint(session_id: str, db: Session = Depends(get_db)):
@@ -495,7 +623,7 @@ def get_question_endpoint(session_id: str, db: Session = Depends(get_db)):
     # if completed already -> respond done
     if session.status == "completed":
         closing_text = f"Thank you {session.candidate_name}! You've completed the interview."
-        return {"question_id": None, "is_complete": True, "question_text": closing_text, "audio_url": text_to_speech_file(closing_text, session_id)}
+        return {"question_id": None, "is_complete": True, "question_text": closing_text, "audio_url": text_to_speech_file(closing_text)}
 
     main_count = count_main_answers(session.id, db)
     if main_count >= MAX_QUESTIONS:
@@ -505,25 +633,23 @@ def get_question_endpoint(session_id: str, db: Session = Depends(get_db)):
         session.pending_followup = None
         db.commit()
         closing_text = f"Thank you {session.candidate_name}! You've completed the interview (max questions reached)."
-        return {"question_id": None, "is_complete": True, "question_text": closing_text, "audio_url": text_to_speech_file(closing_text, session_id)}
+        return {"question_id": None, "is_complete": True, "question_text": closing_text, "audio_url": text_to_speech_file(closing_text)}
 
     # pending followup first
     if session.pending_followup:
-        has_answers = db.query(Answer).filter(Answer.session_id == session.id).first() is not None
-        is_intro = (not has_answers) and session.status == "in_progress"
-        return {"question_id": None, "is_followup": True, "question_text": session.pending_followup, "audio_url": text_to_speech_file(session.pending_followup, session_id)}
+        return {"question_id": None, "is_followup": True, "question_text": session.pending_followup, "audio_url": text_to_speech_file(session.pending_followup)}
 
     # next DB question
     next_question = get_interview_question(session, db)
     if next_question:
-        return {"question_id": next_question.id, "is_followup": False, "question_text": next_question.question_text, "audio_url": text_to_speech_file(next_question.question_text, session_id)}
+        return {"question_id": next_question.id, "is_followup": False, "question_text": next_question.question_text, "audio_url": text_to_speech_file(next_question.question_text)}
 
     # no more questions -> finalize
     session.status = "completed"
     session.completed_at = datetime.utcnow()
     db.commit()
     closing_text = f"Thank you {session.candidate_name}! You've completed all the questions. You'll see the results now."
-    return {"question_id": None, "is_complete": True, "question_text": closing_text, "audio_url": text_to_speech_file(closing_text, session_id)}
+    return {"question_id": None, "is_complete": True, "question_text": closing_text, "audio_url": text_to_speech_file(closing_text)}
 
 @app.post("/api/sessions/{session_id}/answer")
 async def submit_answer(
@@ -556,7 +682,7 @@ async def submit_answer(
                 question_id = next_q.id
                 question_text = next_q.question_text
         else:
-            qobj = db.query(Question).filter(Question.id == question_id).first()
+            qobj = db.query(Question).options(load_only(Question.question_text)).filter(Question.id == question_id).first()
             if not qobj:
                 raise HTTPException(status_code=404, detail="Question not found")
             question_text = qobj.question_text
@@ -575,9 +701,9 @@ async def submit_answer(
                     tmp.write(content)
                     tmp_path = tmp.name
                 try:
-                    audio_seg = pydub.AudioSegment.from_file(tmp_path)
                     wav_path = tmp_path + ".wav"
-                    audio_seg.export(wav_path, format="wav")
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(None, convert_audio_to_wav, tmp_path, wav_path)
                     user_answer_text = await speech_service.transcribe_audio(wav_path)
                 except Exception as e:
                     print("pydub conversion/transcription failed:", e)
@@ -649,12 +775,20 @@ async def get_session_report(session_id: str, db: Session = Depends(get_db)):
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    answers_objs = db.query(Answer).filter(Answer.session_id == session_id).all()
-    if not answers_objs:
+    # plain column rows: the report only serializes these fields, no ORM instances needed
+    answer_rows = db.query(
+        Answer.question_id,
+        Answer.user_answer,
+        Answer.score,
+        Answer.feedback,
+        Answer.time_spent,
+        Answer.is_followup,
+    ).filter(Answer.session_id == session_id).all()
+    if not answer_rows:
         raise HTTPException(status_code=404, detail="No answers found for session")
 
     answers = []
-    for a in answers_objs:
+    for a in answer_rows:
         answers.append({
             "question_id": a.question_id,
             "user_answer": a.user_answer,
@@ -678,16 +812,7 @@ async def get_session_report(session_id: str, db: Session = Depends(get_db)):
         analysis = await generate_analysis_with_gemini(answers, average_score, session.candidate_name)
     except Exception as e:
         print("Analysis generation failed:", e)
-        analysis = {
-            "communication_score": round(average_score * 0.9, 1),
-            "presentation_score": round(average_score * 0.85, 1),
-            "clarity_score": round(average_score * 0.9, 1),
-            "confidence_score": round(average_score * 0.8, 1),
-            "problem_solving_score": round(average_score, 1),
-            "overall_score": round(average_score, 1),
-            "summary": "Overall solid performance. Focus on structuring responses and practicing clarity.",
-            "suggestions": ["Structure answers with 3 steps (what/why/how).", "Practice concise explanations out loud."]
-        }
+        analysis = fallback_analysis(average_score)
 
     # Build result object
     result = {
@@ -712,15 +837,11 @@ async def get_session_report(session_id: str, db: Session = Depends(get_db)):
         "suggestions": analysis.get("suggestions", []),
     }
 
-    pdf_url = create_pdf_report(result, session_id)
+    # PDF layout and report serialization are blocking; keep them off the event loop
+    loop = asyncio.get_running_loop()
+    pdf_url = await loop.run_in_executor(None, create_pdf_report, result, session_id)
     result["report_url"] = pdf_url
-
-    try:
-        json_path = os.path.join(REPORTS_DIR, f"report_{session_id}.json")
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(result, f, indent=2)
-    except Exception as e:
-        print("Failed to write JSON report:", e)
+    await loop.run_in_executor(None, write_json_report, result, session_id)
 
     # Return result with finish_url (frontend can redirect to this)
     finish_url = f"/finish?session_id={session_id}"
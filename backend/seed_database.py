@@ -1,79 +1,176 @@
-import os
-import json
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from main import Base, Question
-import google.generativeai as genai
+import random
+import asyncio
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
 from pathlib import Path
 env_path = Path(__file__).resolve().parents[1] / ".env"
 load_dotenv(dotenv_path=env_path)
-DATABASE_URL = os.getenv("DATABASE_URL")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Configure Gemini
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel("gemini-1.5-flash-latest")
+# main configures Gemini and the database from the environment loaded above
+from main import Base, Question, engine, gemini_model, parse_ai_json, GEMINI_TRANSIENT_ERRORS
+
+DIFFICULTY_LEVELS = ["beginner", "intermediate", "advanced"]
+QUESTIONS_PER_DIFFICULTY = 5
+MAX_CONCURRENT_REQUESTS = 3
+REQUIRED_FIELDS = ("category", "question_text", "question_type")
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
 
 def create_database():
-    engine = create_engine(
-        DATABASE_URL,
-        connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-    )
+    # reuse the app's engine and pool instead of opening a second one
     Base.metadata.create_all(bind=engine)
+    # create_all skips indexes on tables that already exist, so add the dedupe index explicitly
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_questions_question_text ON questions (question_text)"
+        )
     return engine
 
-def generate_questions():
-    """Ask Gemini to generate Excel interview questions"""
-    prompt = """
-    Generate 15 Excel interview questions in JSON.
+def insert_questions(conn, rows):
+    """Insert question rows, skipping any whose question_text already exists"""
+    if not rows:
+        return 0
+    # Core insert on the table: one executemany, no ORM flush/event machinery per row
+    questions_table = Question.__table__
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    stmt = (
+        insert(questions_table)
+        .on_conflict_do_nothing(index_elements=["question_text"])
+        .returning(questions_table.c.id)
+    )
+    return len(conn.execute(stmt, rows).all())
+
+QUESTION_PROMPT = """
+    Generate {count} {difficulty} Excel interview questions in JSON.
     Each item must have:
-    {
+    {{
       "category": "string",
-      "difficulty": "beginner|intermediate|advanced",
+      "difficulty": "{difficulty}",
       "question_text": "string",
       "question_type": "conceptual|practical",
       "canonical_answer": "string",
       "tags": "comma,separated,tags"
-    }
+    }}
     Ensure valid JSON array only, no markdown or explanation.
     """
-    response = gemini_model.generate_content(prompt)
-    text = response.text.strip()
-    text = text.replace("```json", "").replace("```", "")
-    return json.loads(text)
+
+def server_retry_delay(error):
+    """Wait the server asked for in a google.rpc.RetryInfo error detail, if any"""
+    # generate_content_async goes over gRPC, where quota errors carry RetryInfo in
+    # error.details rather than a Retry-After header
+    for detail in getattr(error, "details", None) or ():
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is None:
+            continue
+        seconds = retry_delay.seconds + retry_delay.nanos / 1e9
+        if seconds > 0:
+            return seconds
+    return None
+
+async def generate_content_with_retry(prompt):
+    """Call Gemini, retrying transient errors with decorrelated-jitter backoff"""
+    delay = RETRY_BASE_DELAY
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await gemini_model.generate_content_async(prompt)
+        except GEMINI_TRANSIENT_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            # decorrelated jitter keeps the concurrent batches from retrying in lockstep
+            delay = min(RETRY_MAX_DELAY, random.uniform(RETRY_BASE_DELAY, delay * 3))
+            wait = server_retry_delay(e)
+            if wait is None:
+                wait = delay
+            elif wait > RETRY_MAX_DELAY:
+                # a long quota window won't clear within this run; give up on the batch instead of stalling
+                raise
+            print(f"Gemini call failed ({e}), retrying in {wait:.1f}s")
+            await asyncio.sleep(wait)
+
+async def generate_questions_for_difficulty(difficulty, semaphore):
+    """Ask Gemini to generate Excel interview questions of one difficulty"""
+    prompt = QUESTION_PROMPT.format(count=QUESTIONS_PER_DIFFICULTY, difficulty=difficulty)
+    async with semaphore:
+        response = await generate_content_with_retry(prompt)
+    # a reply without a JSON array raises here, so gather drops only this difficulty's batch
+    batch = parse_ai_json(response.text, expected=list)
+    questions = []
+    for q in batch:
+        # a single malformed item is skipped; canonical_answer is nullable like its column
+        if not isinstance(q, dict) or any(not isinstance(q.get(k), str) for k in REQUIRED_FIELDS):
+            print(f"Skipping {difficulty} question missing required fields: {q!r}")
+            continue
+        canonical_answer = q.get("canonical_answer")
+        if canonical_answer is not None and not isinstance(canonical_answer, str):
+            canonical_answer = str(canonical_answer)
+        # get_interview_question matches difficulty exactly, so don't trust the model's spelling
+        tags = q.get("tags") or ""
+        if isinstance(tags, list):
+            tags = ",".join(str(t) for t in tags)
+        questions.append({**q, "difficulty": difficulty, "canonical_answer": canonical_answer, "tags": str(tags)})
+    return questions
+
+async def generate_questions():
+    """Generate questions for every difficulty level concurrently"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    batches = await asyncio.gather(
+        *(generate_questions_for_difficulty(d, semaphore) for d in DIFFICULTY_LEVELS),
+        return_exceptions=True,
+    )
+    questions = []
+    for difficulty, batch in zip(DIFFICULTY_LEVELS, batches):
+        if isinstance(batch, Exception):
+            print(f"Error generating {difficulty} questions: {batch}")
+            continue
+        questions.extend(batch)
+    return questions
 
 def seed_questions():
     """Seed database with AI-generated questions"""
-    engine = create_database()
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
+    # gemini_model is resolved once when main is imported; without it every batch would fail
+    if gemini_model is None:
+        print("GEMINI_API_KEY not set, skipping AI question seeding")
+        return
 
     try:
-        questions = generate_questions()
-        added = 0
-        for q in questions:
-            exists = db.query(Question).filter(Question.question_text == q["question_text"]).first()
-            if exists:
-                continue
-            question = Question(
-                category=q["category"],
-                difficulty=q["difficulty"],
-                question_text=q["question_text"],
-                question_type=q["question_type"],
-                canonical_answer=q["canonical_answer"],
-                tags=q.get("tags", "")
-            )
-            db.add(question)
-            added += 1
+        create_database()
+    except IntegrityError:
+        print(
+            "Cannot create the unique index on questions.question_text: the table already "
+            "contains duplicate question texts. Remove the duplicate rows and re-run the seeder."
+        )
+        return
 
-        db.commit()
+    try:
+        # generate before opening the transaction so no connection is held during API calls
+        questions = asyncio.run(generate_questions())
+        with engine.connect() as conn:
+            if engine.dialect.name == "sqlite":
+                # seeding only: trade per-commit fsync for throughput on this connection;
+                # SQLite refuses to change synchronous inside a transaction, so set it first
+                conn.exec_driver_sql("PRAGMA synchronous=NORMAL")
+                conn.exec_driver_sql("PRAGMA temp_store=MEMORY")
+                conn.exec_driver_sql("PRAGMA cache_size=-65536")
+                conn.commit()
+            # commits once on success, rolls back on any error
+            with conn.begin():
+                rows = [
+                    {
+                        "category": q["category"],
+                        "difficulty": q["difficulty"],
+                        "question_text": q["question_text"],
+                        "question_type": q["question_type"],
+                        "canonical_answer": q["canonical_answer"],
+                        "tags": q["tags"],
+                    }
+                    for q in questions
+                ]
+                added = insert_questions(conn, rows)
         print(f"Added {added} AI-generated questions")
     except Exception as e:
         print(f"Error seeding: {e}")
-        db.rollback()
-    finally:
-        db.close()
 
 if __name__ == "__main__":
     seed_questions()
\ No newline at end of file